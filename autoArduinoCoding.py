@@ -5,7 +5,7 @@
 
 執行前置作業:
 1. 安裝必要的 Python 函式庫:
-   pip install "fastapi[all]" requests pyserial
+   pip install "fastapi[all]" "httpx[http2]" orjson pyserial
 2. 設定環境變數:
    - Windows: set GOOGLE_API_KEY=您的API金鑰
    - macOS/Linux: export GOOGLE_API_KEY=您的API金鑰
@@ -13,30 +13,76 @@
    請參考官方文件安裝: https://arduino.github.io/arduino-cli/latest/installation/
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import gzip
 import json
+import orjson
+import hashlib
 import subprocess
 import asyncio
+import atexit
 import os
 import tempfile
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
 import serial.tools.list_ports
 from typing import List, Dict, Any, Tuple
-import requests
+import httpx
 import re
 import shutil
+import urllib.request
+
+# --------------------------------------------------------------------------
+# Module-level Constants
+# --------------------------------------------------------------------------
+# 預先編譯的正則表達式，避免在每次 AI 回應 / 每次編譯時重新編譯
+_JSON_FENCE_RE = re.compile(r'```json\s*|\s*```', re.DOTALL)
+_INCLUDE_RE = re.compile(r'#include\s*<([^>]+)\.h>')
+
+# Gemini API 的模型端點（依呼叫方式接上 :generateContent / :streamGenerateContent）
+_GEMINI_MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest"
+
+# Arduino 設備辨識用的關鍵字（預先轉為小寫）與 VID 集合
+_ARDUINO_ID_TOKENS = tuple(t.lower() for t in
+    ['Arduino', 'CH340', 'CP210x', 'FTDI', 'USB-SERIAL', 'Seeeduino', 'XIAO', 'ESP32'])
+_ARDUINO_VID_PIDS = frozenset({"2341", "1A86", "10C4", "0403", "2886", "303A"})
 
 # --------------------------------------------------------------------------
 # FastAPI App Initialization
 # --------------------------------------------------------------------------
-app = FastAPI(title="文字驅動Arduino自動程式生成系統")
+app = FastAPI(title="文字驅動Arduino自動程式生成系統", default_response_class=ORJSONResponse)
+
+class CachedStaticFiles(StaticFiles):
+    """靜態檔案服務，附上快取標頭並保留 ETag 重新驗證。"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        # 這裡的檔名沒有內容指紋（如 marked.min.js 更新後名稱不變），
+        # 不能標 immutable；用適中的 max-age，過期後靠 ETag 重新驗證
+        response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
 
 # --- 靜態檔案服務 (如果需要) ---
 if not os.path.exists("static"):
     os.makedirs("static")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# 將 marked.min.js 併入本地靜態資源，移除渲染路徑上對第三方 CDN 的跨域請求
+_MARKED_JS_PATH = os.path.join("static", "marked.min.js")
+if not os.path.exists(_MARKED_JS_PATH):
+    try:
+        # 設定逾時上限：離線或被防火牆擋下時，啟動流程會直接退回 CDN 備援而不是卡死
+        with urllib.request.urlopen("https://cdn.jsdelivr.net/npm/marked/marked.min.js", timeout=10) as resp:
+            marked_js = resp.read()
+        with open(_MARKED_JS_PATH, 'wb') as f:
+            f.write(marked_js)
+        print("✅ 已下載 marked.min.js 至 static/")
+    except Exception as e:
+        print(f"⚠️ 無法下載 marked.min.js: {e}，前端將改用 CDN 版本。")
+
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 
 # --------------------------------------------------------------------------
@@ -48,42 +94,76 @@ class TextDrivenArduinoSystem:
     def __init__(self):
         """初始化系統，尋找CLI路徑並讀取API金鑰。"""
         self.user_description: str | None = None
+        self._cli_version_cache: tuple[bool, str] | None = None
         self.arduino_cli_path: str | None = self.find_arduino_cli()
         self.google_api_key: str | None = os.getenv("GOOGLE_API_KEY")
         self._cli_env_setup_done = False # 用於標記環境是否已設定
+        self._cli_data_dir: str | None = None
+        self._index_checked = False # 套件索引在本程序生命週期內只檢查一次
+        # 跨請求共用的建置快取目錄：core.a 與函式庫物件檔只需完整編譯一次，
+        # 之後的編譯／部署僅需重建草稿碼本身的差異
+        self._build_cache_dir = os.path.join(tempfile.gettempdir(), "arduino-cli-cache")
+        os.makedirs(self._build_cache_dir, exist_ok=True)
+        # 內容定址的編譯結果快取：編譯是 (程式碼, fqbn, CLI版本) 的純函式，
+        # 相同輸入可直接重用結果，完全省下一次 arduino-cli 呼叫
+        self._compile_cache: "OrderedDict[str, Tuple[bool, dict]]" = OrderedDict()
+        self._compile_cache_dir = os.path.join(self._build_cache_dir, "results")
+        os.makedirs(self._compile_cache_dir, exist_ok=True)
+        # 串列埠掃描結果的短期快取（Windows 上 USB 枚舉可達數百毫秒），
+        # 讓 /api/debug/devices 輪詢與 deploy 的自動選埠共用同一次掃描
+        self._ports_cache: tuple[float, List[Dict[str, Any]]] | None = None
+        # 常駐的草稿碼根目錄：只在啟動時建立一次，每次編譯在以內容雜湊
+        # 命名的子目錄中重寫 .ino，省去反覆 mkdtemp/rmtree 的系統呼叫，
+        # 不同內容用不同目錄，並行請求之間不會互相覆寫
+        self._sketch_root = tempfile.mkdtemp(prefix="tda_")
+        atexit.register(shutil.rmtree, self._sketch_root, ignore_errors=True)
+        self._deploy_sketch_dir = os.path.join(self._sketch_root, "deploy", "deploy_sketch")
+        os.makedirs(self._deploy_sketch_dir)
+        # 共用的 HTTP 連線池，所有 Gemini 呼叫（含修復迴圈）重複使用同一條連線，
+        # 避免每次呼叫都重新進行 TCP/TLS 握手
+        self._http = httpx.AsyncClient(
+            http2=True, timeout=120,
+            limits=httpx.Limits(max_keepalive_connections=4)
+        )
+
+    async def aclose(self):
+        """關閉共用的 HTTP 連線池，應在伺服器關閉時呼叫。"""
+        await self._http.aclose()
 
     def find_arduino_cli(self) -> str | None:
-        """使用 shutil.which 更可靠地尋找 Arduino CLI 執行檔。"""
+        """使用 shutil.which 更可靠地尋找 Arduino CLI 執行檔，並快取版本資訊。"""
         possible_names = ["arduino-cli", "arduino-cli.exe"]
         for name in possible_names:
             path = shutil.which(name)
             if path:
                 try:
-                    subprocess.run([path, "version"], capture_output=True, text=True, timeout=10, check=True)
+                    res = subprocess.run([path, "version"], capture_output=True, text=True, timeout=10, check=True)
                     print(f"✅ 找到可正常執行的 Arduino CLI: {path}")
+                    self._cli_version_cache = (True, res.stdout.strip())
                     return path
                 except Exception as e:
                     print(f"   - 找到路徑 {path} 但無法執行: {e}")
                     continue
         print("⚠️ 警告: 找不到 Arduino CLI。編譯與部署功能將無法使用。")
+        self._cli_version_cache = (False, "N/A")
         return None
 
     def detect_arduino_devices(self) -> List[Dict[str, Any]]:
-        """檢測連接的 Arduino 設備。"""
+        """檢測連接的 Arduino 設備，結果快取 2 秒以避免重複的 OS 枚舉。"""
+        if self._ports_cache is not None and time.monotonic() - self._ports_cache[0] < 2.0:
+            return self._ports_cache[1]
         devices = []
         try:
             ports = list(serial.tools.list_ports.comports())
         except Exception as e:
             print(f"❌ 掃描串列埠時發生錯誤: {e}")
             return []
-        arduino_identifiers = ['Arduino', 'CH340', 'CP210x', 'FTDI', 'USB-SERIAL', 'Seeeduino', 'XIAO', 'ESP32']
-        arduino_vid_pids = ["2341", "1A86", "10C4", "0403", "2886", "303A"]
         print(f"🔍 掃描到 {len(ports)} 個串列埠...")
         for port in ports:
-            is_arduino = False
-            if any(identifier.lower() in str(port.description).lower() or identifier.lower() in str(port.manufacturer).lower() for identifier in arduino_identifiers):
-                is_arduino = True
-            if port.vid and f"{port.vid:04X}".upper() in arduino_vid_pids:
+            # 小寫字串每個埠只計算一次，再對預先小寫化的關鍵字做單次掃描
+            haystack = f"{port.description or ''}\0{port.manufacturer or ''}".lower()
+            is_arduino = any(token in haystack for token in _ARDUINO_ID_TOKENS)
+            if not is_arduino and port.vid and f"{port.vid:04X}" in _ARDUINO_VID_PIDS:
                 is_arduino = True
             devices.append({
                 'port': port.device, 'description': port.description,
@@ -92,46 +172,99 @@ class TextDrivenArduinoSystem:
                 'is_arduino': is_arduino
             })
         print(f"🎯 找到 {len([d for d in devices if d['is_arduino']])} 個可能的 Arduino 設備")
+        self._ports_cache = (time.monotonic(), devices)
         return devices
 
-    async def _call_gemini_api(self, prompt: str, is_json_output: bool = False) -> str | None:
-        """通用的 Gemini API 呼叫函式，處理網路請求。"""
+    def _gemini_payload(self, prompt: str, is_json_output: bool, **config_overrides) -> dict:
+        """組合 Gemini API 請求的 payload，集中 API 金鑰檢查與 generationConfig 預設值。"""
         if not self.google_api_key:
             raise ValueError("Google API key 未設定 (請設定環境變數 GOOGLE_API_KEY)")
 
-        headers = {"Content-Type": "application/json"}
         generation_config = {"temperature": 0.2, "topP": 0.9, "maxOutputTokens": 8192}
+        generation_config.update(config_overrides)
         if is_json_output:
             generation_config["responseMimeType"] = "application/json"
-            
-        payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": generation_config}
-        
+
+        return {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": generation_config}
+
+    async def _call_gemini_api(self, prompt: str, is_json_output: bool = False) -> str | None:
+        """通用的 Gemini API 呼叫函式，處理網路請求。"""
+        payload = self._gemini_payload(prompt, is_json_output)
         try:
-            response = await asyncio.to_thread(
-                requests.post,
-                f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent?key={self.google_api_key}",
-                headers=headers, json=payload, timeout=120
-            )
+            response = await self._http.post(
+                f"{_GEMINI_MODEL_URL}:generateContent?key={self.google_api_key}", json=payload)
             response.raise_for_status()
-            result = response.json()
+            # orjson 直接解析 bytes，省去一次 str 解碼且解析速度快數倍
+            result = orjson.loads(response.content)
             return result['candidates'][0]['content']['parts'][0]['text']
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"❌ Gemini API 請求失敗: {e}")
             return None
 
+    async def _call_gemini_api_candidates(self, prompt: str, is_json_output: bool = False, candidate_count: int = 3) -> List[str]:
+        """單次 API 呼叫要求多個候選回應，回傳所有候選的文字內容。
+
+        一次批次呼叫取代多輪序列式的 LLM 往返；候選之間用較高的
+        temperature 增加多樣性，提升至少一個候選可編譯的機率。
+        """
+        payload = self._gemini_payload(prompt, is_json_output,
+                                       temperature=0.7, candidateCount=candidate_count)
+        try:
+            response = await self._http.post(
+                f"{_GEMINI_MODEL_URL}:generateContent?key={self.google_api_key}", json=payload)
+            response.raise_for_status()
+            result = orjson.loads(response.content)
+            texts = []
+            for candidate in result.get('candidates', []):
+                try:
+                    texts.append(candidate['content']['parts'][0]['text'])
+                except (KeyError, IndexError):
+                    continue
+            return texts
+        except httpx.HTTPError as e:
+            print(f"❌ Gemini API 請求失敗: {e}")
+            return []
+
+    async def _call_gemini_api_stream(self, prompt: str, is_json_output: bool = False):
+        """以串流方式呼叫 Gemini API，逐段產出文字增量。
+
+        使用 streamGenerateContent 端點，讓前端在模型生成期間就能看到輸出，
+        而不是等待整份回應（10-30 秒）後才有任何回饋。
+        """
+        payload = self._gemini_payload(prompt, is_json_output)
+        url = f"{_GEMINI_MODEL_URL}:streamGenerateContent?alt=sse&key={self.google_api_key}"
+        try:
+            async with self._http.stream("POST", url, json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    try:
+                        chunk = orjson.loads(line[6:])
+                        yield chunk['candidates'][0]['content']['parts'][0]['text']
+                    except (orjson.JSONDecodeError, KeyError, IndexError):
+                        continue
+        except httpx.HTTPError as e:
+            print(f"❌ Gemini API 串流請求失敗: {e}")
+
     def _extract_code_from_json(self, text: str) -> dict | None:
         """從 AI 回應的 JSON 文本中提取內容。"""
+        # JSON 模式下回應通常已是合法 JSON，直接解析即可；
+        # 只在少數帶有 Markdown 圍欄的回應上才退回正則清理的慢路徑
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
         try:
-            # Gemini 在 JSON 模式下有時會包含 Markdown 標籤，需要先移除
-            clean_text = re.sub(r'```json\s*|\s*```', '', text, flags=re.DOTALL).strip()
-            return json.loads(clean_text)
-        except json.JSONDecodeError:
+            clean_text = _JSON_FENCE_RE.sub('', text).strip()
+            return orjson.loads(clean_text)
+        except orjson.JSONDecodeError:
             print(f"❌ 解析 AI 的 JSON 回應失敗。原始文本: {text}")
             return None
 
-    async def generate_code_and_instructions(self, description: str) -> dict | None:
-        """【核心功能】【已升級】讓 AI 同時生成程式碼和接線指南。"""
-        prompt = f"""作為一位資深的 Arduino 開發與教學專家，請根據以下用戶描述，生成一份包含 Arduino 程式碼和硬體接線指南的 JSON 物件。
+    def _build_generation_prompt(self, description: str) -> str:
+        """組合生成程式碼與接線指南的提示詞。"""
+        return f"""作為一位資深的 Arduino 開發與教學專家，請根據以下用戶描述，生成一份包含 Arduino 程式碼和硬體接線指南的 JSON 物件。
 
 ### 用戶需求描述:
 {description}
@@ -157,7 +290,10 @@ class TextDrivenArduinoSystem:
 ```
 
 請開始生成 JSON 物件："""
-        
+
+    async def generate_code_and_instructions(self, description: str) -> dict | None:
+        """【核心功能】【已升級】讓 AI 同時生成程式碼和接線指南。"""
+        prompt = self._build_generation_prompt(description)
         response_text = await self._call_gemini_api(prompt, is_json_output=True)
         return self._extract_code_from_json(response_text) if response_text else None
 
@@ -167,22 +303,25 @@ class TextDrivenArduinoSystem:
             return
 
         print("🔧 正在設定並檢查 Arduino CLI 環境...")
-        await asyncio.gather(
-            self._run_cli_command("core", "update-index"),
+        setup_tasks = [
             self._run_cli_command("core", "install", ":".join(fqbn.split(":")[:2]))
-        )
-        
-        required_libs = re.findall(r'#include\s*<([^>]+)\.h>', code)
+        ]
+        # core update-index 會進行完整的網路下載（數秒），索引仍新鮮時直接跳過
+        if not await self._package_index_is_fresh():
+            setup_tasks.insert(0, self._run_cli_command("core", "update-index"))
+        self._index_checked = True
+
+        required_libs = set(_INCLUDE_RE.findall(code))
         if "Servo" not in required_libs and "Servo.h" not in code and "myServo" in code:
-             required_libs.append("Servo")
+             required_libs.add("Servo")
 
         if required_libs:
-            print(f"   - 程式碼需要函式庫: {set(required_libs)}")
-            install_tasks = []
-            for lib in set(required_libs): 
-                lib_name_for_install = f'"{lib}"' if "Adafruit" in lib else lib
-                install_tasks.append(self._run_cli_command("lib", "install", lib_name_for_install))
-            await asyncio.gather(*install_tasks)
+            print(f"   - 程式碼需要函式庫: {required_libs}")
+            # arduino-cli 支援一次安裝多個函式庫，將 N 次 CLI 啟動成本縮減為 1 次。
+            # create_subprocess_exec 不經過 shell，參數原樣傳遞，名稱含空格也不需額外引號。
+            setup_tasks.append(self._run_cli_command("lib", "install", *sorted(required_libs)))
+
+        await asyncio.gather(*setup_tasks)
         
         self._cli_env_setup_done = True
         print("✅ CLI 環境設定完成。")
@@ -193,6 +332,27 @@ class TextDrivenArduinoSystem:
         proc = await asyncio.create_subprocess_exec(self.arduino_cli_path, *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
         await proc.wait()
 
+    async def _run_cli_command_capture(self, *args) -> str:
+        """執行一個 CLI 命令並擷取其標準輸出。"""
+        if not self.arduino_cli_path: return ""
+        proc = await asyncio.create_subprocess_exec(self.arduino_cli_path, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await proc.communicate()
+        return stdout.decode(errors='ignore').strip()
+
+    async def _package_index_is_fresh(self) -> bool:
+        """檢查 arduino-cli 的套件索引是否在 24 小時內更新過。"""
+        if self._index_checked:
+            return True
+        if self._cli_data_dir is None:
+            self._cli_data_dir = await self._run_cli_command_capture("config", "get", "directories.data")
+        if not self._cli_data_dir:
+            return False
+        try:
+            mtime = os.path.getmtime(os.path.join(self._cli_data_dir, "package_index.json"))
+        except OSError:
+            return False
+        return mtime > time.time() - 86400
+
 
     async def validate_and_fix_code(self, generation_result: dict, fqbn: str = "Seeeduino:samd:seeed_XIAO_m0") -> Tuple[bool, dict]:
         """驗證並在失敗時嘗試使用 AI 自動修復程式碼。"""
@@ -202,14 +362,25 @@ class TextDrivenArduinoSystem:
         code = generation_result.get("arduino_code", "")
         await self.setup_cli_environment(code, fqbn)
 
+        # 所有編譯嘗試共用常駐的草稿碼目錄，讓 arduino-cli 的增量建置快取
+        # （core.a、未變動的函式庫物件檔）在嘗試之間、甚至請求之間重複使用
+        last_code_hash: str | None = None
         for attempt in range(3):
+            # Gemini 偶爾會原封不動重複上一輪的程式碼；此時再編譯／再修復
+            # 只是重演相同的失敗，直接提前結束迴圈
+            code_hash = hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+            if code_hash == last_code_hash:
+                print("❌ AI 重複回傳相同的程式碼，提前結束修復迴圈。")
+                break
+            last_code_hash = code_hash
+
             print(f"🔧 正在進行第 {attempt + 1} 次編譯嘗試...")
             success, result = await self._compile_code(code, fqbn)
             if success:
                 print(f"✅ 程式碼在第 {attempt + 1} 次嘗試時編譯成功！")
                 generation_result["arduino_code"] = code
                 return True, generation_result
-            
+
             if attempt == 2: break
 
             print(f"❌ 第 {attempt + 1} 次編譯失敗，將錯誤資訊傳送給 AI 進行修復...")
@@ -236,39 +407,153 @@ class TextDrivenArduinoSystem:
 3.  **保持 JSON 格式**: 你的回應必須是包含 `"arduino_code"` 和 `"wiring_instructions"` 的完整 JSON 物件。`"wiring_instructions"` 應保持不變。
 
 請開始修正 JSON 物件："""
-            
-            fixed_response_text = await self._call_gemini_api(fix_prompt, is_json_output=True)
-            if not fixed_response_text:
+
+            # 一次要求 3 個修復候選，再平行編譯，取代多輪序列式的 LLM 往返
+            fixed_texts = await self._call_gemini_api_candidates(fix_prompt, is_json_output=True)
+            if not fixed_texts:
+                # 批次請求失敗時（部分模型對 candidateCount > 1 回 400），
+                # 退回既有的單一候選路徑再試一次，不讓修復功能整個失效
+                print("⚠️ 批次候選請求失敗，改以單一候選重試...")
+                single_text = await self._call_gemini_api(fix_prompt, is_json_output=True)
+                fixed_texts = [single_text] if single_text else []
+            if not fixed_texts:
                 print("❌ AI 未能提供修復後的程式碼。")
                 return False, generation_result
-            
-            fixed_result = self._extract_code_from_json(fixed_response_text)
-            if fixed_result and "arduino_code" in fixed_result:
-                code = fixed_result["arduino_code"]
-                generation_result = fixed_result
-            else:
+
+            candidates = []
+            for text in fixed_texts:
+                fixed_result = self._extract_code_from_json(text)
+                if fixed_result and "arduino_code" in fixed_result:
+                    candidates.append(fixed_result)
+            if not candidates:
                 print("❌ AI 的修復回應格式不正確。")
                 return False, generation_result
 
+            # 以內容雜湊去重，避免相同的候選同時寫入同一個草稿碼目錄；
+            # 其餘候選交給 _compile_code 的預設雜湊目錄，彼此平行互不干擾
+            candidates = list({self._compile_cache_key(c["arduino_code"], fqbn): c for c in candidates}.values())
+            print(f"   - 收到 {len(candidates)} 個修復候選，平行編譯驗證中...")
+            outcomes = await asyncio.gather(
+                *[self._compile_code(candidate["arduino_code"], fqbn) for candidate in candidates])
+
+            winner = next((c for c, (ok, _) in zip(candidates, outcomes) if ok), None)
+            if winner is not None:
+                print(f"✅ 修復候選在第 {attempt + 1} 輪驗證成功！")
+                return True, winner
+
+            # 全部候選都失敗，帶著第一個候選的錯誤進入下一輪修復
+            code = candidates[0]["arduino_code"]
+            generation_result = candidates[0]
+
         print("❌ AI 經過多次修復後仍然編譯失敗。")
         return False, generation_result
 
     async def _compile_code(self, code: str, fqbn: str) -> Tuple[bool, dict]:
-        """內部使用的編譯函式，返回成功狀態和結果。"""
-        with tempfile.TemporaryDirectory(prefix="arduino_compile_") as temp_dir:
-            sketch_dir = os.path.join(temp_dir, "temp_sketch")
-            os.makedirs(sketch_dir)
-            with open(os.path.join(sketch_dir, "temp_sketch.ino"), 'w', encoding='utf-8') as f:
-                f.write(code)
-
-            compile_cmd = [self.arduino_cli_path, "compile", "--fqbn", fqbn, sketch_dir]
-            proc = await asyncio.create_subprocess_exec(*compile_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            stdout, stderr = await proc.communicate()
-            
-            return proc.returncode == 0, {"stdout": stdout.decode(errors='ignore'), "stderr": stderr.decode(errors='ignore')}
+        """內部使用的編譯函式，返回成功狀態和結果。
+
+        草稿碼目錄一律以內容雜湊命名：相同內容的重編譯路徑固定
+        （arduino-cli 以路徑作為建置快取的鍵），不同內容的並行編譯互不干擾，
+        編譯結果也才能安全地以同一個雜湊鍵寫入快取。
+        """
+        cache_key = self._compile_cache_key(code, fqbn)
+        cached = self._compile_cache_get(cache_key)
+        if cached is not None:
+            print("⚡ 命中編譯結果快取，跳過 arduino-cli 呼叫。")
+            return cached
+
+        sketch_dir = os.path.join(self._sketch_root, cache_key, "temp_sketch")
+        os.makedirs(sketch_dir, exist_ok=True)
+        self._write_sketch(os.path.join(sketch_dir, "temp_sketch.ino"), code)
+
+        # --no-color / --log-level error 只留下有意義的診斷訊息；
+        # stderr 只取最後 8KB，餵給修復提示詞的錯誤訊息更精簡（提示詞按 token 計價）
+        # --output-dir 以內容雜湊鍵存放編譯產物，部署時可直接上傳免重新編譯
+        compile_cmd = [self.arduino_cli_path, "compile", "--fqbn", fqbn, "--no-color", "--log-level", "error",
+                       "--build-cache-path", self._build_cache_dir,
+                       "--output-dir", self._artifacts_dir(cache_key), sketch_dir]
+        # 驗證路徑只需要 stderr，stdout 直接導向 DEVNULL，省去搬運與解碼整條輸出流
+        proc = await asyncio.create_subprocess_exec(*compile_cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await proc.communicate()
+
+        outcome = (proc.returncode == 0, {"stderr": stderr[-8192:].decode(errors='ignore')})
+        self._compile_cache_put(cache_key, outcome)
+        return outcome
+
+    async def _run_streamed(self, cmd: List[str]) -> Tuple[int, str, str]:
+        """執行命令並以固定大小的區塊串流讀取輸出，只保留結尾以限制記憶體用量。
+
+        --verbose 的上傳輸出可能極為冗長；以固定長度的 deque 收集尾端，
+        即使遇到病態冗長的輸出記憶體也有上限。刻意不用逐行讀取：上傳工具
+        常以 \\r 反覆更新進度而不換行，readline 會在超過串流上限時拋出
+        ValueError，直接炸掉進行中的部署。
+        """
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout_tail: deque = deque(maxlen=64)
+        stderr_tail: deque = deque(maxlen=64)
+
+        async def _tail(stream, tail):
+            while True:
+                chunk = await stream.read(8192)
+                if not chunk:
+                    break
+                tail.append(chunk)
+
+        await asyncio.gather(_tail(proc.stdout, stdout_tail), _tail(proc.stderr, stderr_tail))
+        returncode = await proc.wait()
+        return (returncode,
+                b"".join(stdout_tail)[-8192:].decode(errors='ignore'),
+                b"".join(stderr_tail)[-8192:].decode(errors='ignore'))
+
+    @staticmethod
+    def _write_sketch(ino_path: str, code: str):
+        """先寫入同目錄的暫存檔，再以 os.replace 原子性置換 .ino 檔。"""
+        tmp_path = f"{ino_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(code)
+        os.replace(tmp_path, ino_path)
+
+    def _artifacts_dir(self, cache_key: str) -> str:
+        """回傳指定內容雜湊鍵的編譯產物目錄路徑。"""
+        return os.path.join(self._build_cache_dir, "artifacts", cache_key)
+
+    def _compile_cache_key(self, code: str, fqbn: str) -> str:
+        """以 (fqbn, CLI 版本, 程式碼) 計算編譯結果的內容雜湊鍵。"""
+        cli_version = self._cli_version_cache[1] if self._cli_version_cache else ""
+        return hashlib.sha256(f"{fqbn}\0{cli_version}\0{code}".encode()).hexdigest()
+
+    def _compile_cache_get(self, key: str) -> Tuple[bool, dict] | None:
+        """查詢編譯結果快取：記憶體優先，其次讀取磁碟（跨程序重用）。"""
+        if key in self._compile_cache:
+            self._compile_cache.move_to_end(key)
+            return self._compile_cache[key]
+        try:
+            with open(os.path.join(self._compile_cache_dir, f"{key}.json"), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            outcome = (entry["success"], entry["result"])
+        except (OSError, json.JSONDecodeError, KeyError):
+            return None
+        self._compile_cache_put(key, outcome, persist=False)
+        return outcome
+
+    def _compile_cache_put(self, key: str, outcome: Tuple[bool, dict], persist: bool = True):
+        """寫入編譯結果快取，記憶體中以 LRU 方式最多保留 128 筆。
+
+        只有成功結果會寫入磁碟：失敗可能源自當下的環境狀態（例如函式庫
+        安裝剛好網路中斷），不屬於內容雜湊鍵的一部分，不應跨程序永久生效。
+        """
+        self._compile_cache[key] = outcome
+        self._compile_cache.move_to_end(key)
+        if len(self._compile_cache) > 128:
+            self._compile_cache.popitem(last=False)
+        if persist and outcome[0]:
+            try:
+                with open(os.path.join(self._compile_cache_dir, f"{key}.json"), 'w', encoding='utf-8') as f:
+                    json.dump({"success": outcome[0], "result": outcome[1]}, f)
+            except OSError:
+                pass
             
     async def deploy_to_arduino(self, code: str, port: str = "auto", fqbn: str = "Seeeduino:samd:seeed_XIAO_m0") -> Dict[str, Any]:
-        """部署程式到指定的 Arduino 埠，採用穩健的兩步驟流程。"""
+        """部署程式到指定的 Arduino 埠，單次 CLI 呼叫完成編譯與上傳。"""
         if not self.arduino_cli_path:
             return {"success": False, "error": "Arduino CLI 未安裝，無法部署"}
         
@@ -282,31 +567,40 @@ class TextDrivenArduinoSystem:
             port = arduino_ports[0]
             print(f"🎯 自動選擇部署埠: {port}")
 
-        with tempfile.TemporaryDirectory(prefix="arduino_deploy_") as temp_dir:
-            sketch_dir = os.path.join(temp_dir, "deploy_sketch")
-            os.makedirs(sketch_dir)
-            with open(os.path.join(sketch_dir, "deploy_sketch.ino"), 'w', encoding='utf-8') as f:
-                f.write(code)
-
-            print(f"🔧 步驟 1/2: 正在編譯草稿碼...")
-            compile_cmd = [self.arduino_cli_path, "compile", "--fqbn", fqbn, sketch_dir]
-            compile_proc = await asyncio.create_subprocess_exec(*compile_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            _, compile_stderr_bytes = await compile_proc.communicate()
-
-            if compile_proc.returncode != 0:
-                return {"success": False, "error": "部署前編譯失敗", "details": compile_stderr_bytes.decode(errors='ignore')}
-            
-            print("✅ 編譯成功！")
-
-            print(f"📤 步驟 2/2: 正在上傳至 {port}...")
-            upload_cmd = [self.arduino_cli_path, "upload", "-p", port, "--fqbn", fqbn, sketch_dir, "--verbose"]
-            upload_proc = await asyncio.create_subprocess_exec(*upload_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            upload_stdout_bytes, upload_stderr_bytes = await upload_proc.communicate()
-            
-            if upload_proc.returncode != 0:
-                return {"success": False, "error": "上傳失敗", "details": upload_stderr_bytes.decode(errors='ignore')}
-            
-            return {"success": True, "message": "程式碼已成功部署！", "port": port, "output": upload_stdout_bytes.decode(errors='ignore')}
+        # 驗證階段若已成功編譯過完全相同的內容，直接以現成產物上傳，跳過重新編譯
+        cache_key = self._compile_cache_key(code, fqbn)
+        cached = self._compile_cache_get(cache_key)
+        artifacts_dir = self._artifacts_dir(cache_key)
+        if cached is not None and cached[0] and os.path.isdir(artifacts_dir):
+            print(f"⚡ 使用已驗證的編譯產物，直接上傳至 {port}...")
+            # 上傳端使用獨立的草稿碼目錄，不與同雜湊的編譯目錄共用；
+            # --input-dir 內的二進位檔一律以 temp_sketch.ino.* 命名，目錄名只需對應
+            sketch_dir = os.path.join(self._sketch_root, cache_key, "upload", "temp_sketch")
+            os.makedirs(sketch_dir, exist_ok=True)
+            self._write_sketch(os.path.join(sketch_dir, "temp_sketch.ino"), code)
+            upload_cmd = [self.arduino_cli_path, "upload", "--input-dir", artifacts_dir,
+                          "-p", port, "--fqbn", fqbn, "--no-color", "--verbose", sketch_dir]
+            returncode, upload_output, _ = await self._run_streamed(upload_cmd)
+            if returncode == 0:
+                return {"success": True, "message": "程式碼已成功部署！", "port": port, "output": upload_output}
+            print("⚠️ 直接上傳失敗，改走完整編譯＋上傳流程。")
+
+        sketch_dir = self._deploy_sketch_dir
+        self._write_sketch(os.path.join(sketch_dir, "deploy_sketch.ino"), code)
+
+        # 單次 CLI 呼叫同時完成編譯與上傳，省下一次 fork/exec 與 CLI 啟動成本，
+        # 也避免 arduino-cli 重複讀取草稿碼
+        print(f"🚀 正在編譯並上傳至 {port}...")
+        deploy_cmd = [
+            self.arduino_cli_path, "compile", "--fqbn", fqbn, "--upload", "-p", port, "--no-color",
+            "--build-cache-path", self._build_cache_dir, "--verbose", sketch_dir
+        ]
+        returncode, deploy_output, deploy_details = await self._run_streamed(deploy_cmd)
+
+        if returncode != 0:
+            return {"success": False, "error": "編譯或上傳失敗", "details": deploy_details}
+
+        return {"success": True, "message": "程式碼已成功部署！", "port": port, "output": deploy_output}
 
 
 # --------------------------------------------------------------------------
@@ -321,8 +615,9 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>文字驅動Arduino自動生成系統</title>
-    <!-- 引入 Marked.js 用於渲染 Markdown -->
-    <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
+    <!-- 引入 Marked.js 用於渲染 Markdown（本地版本，CDN 作為備援） -->
+    <script src="/static/marked.min.js"></script>
+    <script>if (typeof marked === 'undefined') document.write('<script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"><\\/script>');</script>
     <style>
         body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; margin: 0; background-color: #f0f2f5; color: #1c1e21; }
         .container { max-width: 900px; margin: 2rem auto; padding: 0 1rem; }
@@ -434,29 +729,29 @@ HTML_TEMPLATE = """
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ description })
                 });
-                const result = await response.json();
-                
-                if (!response.ok) {
-                    let errorMsg = result.error || '未知錯誤';
-                    if (result.arduino_code) { // 即使失敗也可能返回程式碼
-                        codeEditor.value = "// ---- 以下為最終失敗的程式碼 ----\\n\\n" + result.arduino_code;
-                        codeEditor.style.display = 'block';
-                    }
-                    throw new Error(errorMsg);
-                }
-                
-                showStatus(resultMessageDiv, `✅ ${result.message}`, 'success');
-                
-                // 【新】顯示接線指南
-                if (result.wiring_instructions) {
-                    wiringGuideDiv.innerHTML = marked.parse(result.wiring_instructions);
-                    wiringGuideDiv.style.display = 'block';
+
+                if (!response.ok || !response.body) {
+                    const result = await response.json();
+                    throw new Error(result.error || '未知錯誤');
                 }
 
-                codeEditor.value = result.arduino_code;
+                // 以 SSE 串流接收：AI 一邊生成，編輯區一邊即時顯示
+                codeEditor.value = '';
                 codeEditor.style.display = 'block';
-                deployBtn.disabled = false;
-
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let done = false;
+                while (!done) {
+                    const chunk = await reader.read();
+                    done = chunk.done;
+                    if (chunk.value) buffer += decoder.decode(chunk.value, { stream: !done });
+                    let sep;
+                    while ((sep = buffer.indexOf('\\n\\n')) !== -1) {
+                        handleGenerateEvent(buffer.slice(0, sep));
+                        buffer = buffer.slice(sep + 2);
+                    }
+                }
             } catch (e) {
                 showStatus(resultMessageDiv, `❌ 處理失敗: ${e.message}`, 'error');
             } finally {
@@ -464,6 +759,35 @@ HTML_TEMPLATE = """
                 generateBtn.textContent = '🚀 AI 生成程式碼與接線指南';
             }
         }
+
+        function handleGenerateEvent(raw) {
+            let event = 'message', data = '';
+            for (const line of raw.split('\\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (!data) return;
+            const payload = JSON.parse(data);
+            if (event === 'delta') {
+                codeEditor.value += payload.text;
+                codeEditor.scrollTop = codeEditor.scrollHeight;
+            } else if (event === 'status') {
+                showStatus(resultMessageDiv, payload.message, 'info');
+            } else if (event === 'result') {
+                showStatus(resultMessageDiv, `✅ ${payload.message}`, 'success');
+                if (payload.wiring_instructions) {
+                    wiringGuideDiv.innerHTML = marked.parse(payload.wiring_instructions);
+                    wiringGuideDiv.style.display = 'block';
+                }
+                codeEditor.value = payload.arduino_code;
+                deployBtn.disabled = false;
+            } else if (event === 'error') {
+                if (payload.arduino_code) { // 即使失敗也可能返回程式碼
+                    codeEditor.value = "// ---- 以下為最終失敗的程式碼 ----\\n\\n" + payload.arduino_code;
+                }
+                showStatus(resultMessageDiv, `❌ 處理失敗: ${payload.error}`, 'error');
+            }
+        }
         
         async function deployCode() {
             const codeToDeploy = codeEditor.value;
@@ -504,75 +828,103 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# 啟動時一次性完成 UTF-8 編碼與 gzip 壓縮，每個 GET 直接回傳預先算好的位元組
+HTML_TEMPLATE_BYTES = HTML_TEMPLATE.encode("utf-8")
+HTML_TEMPLATE_GZIP = gzip.compress(HTML_TEMPLATE_BYTES, 9)
+
 # --------------------------------------------------------------------------
 # FastAPI API Routes
 # --------------------------------------------------------------------------
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
-    """提供主頁面 HTML。"""
-    return HTMLResponse(content=HTML_TEMPLATE)
+@app.get("/")
+async def read_root(request: Request):
+    """提供主頁面 HTML（預先編碼與壓縮的位元組，省去每次請求的處理成本）。"""
+    headers = {"Cache-Control": "public, max-age=300"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        return Response(content=HTML_TEMPLATE_GZIP, media_type="text/html; charset=utf-8", headers=headers)
+    return Response(content=HTML_TEMPLATE_BYTES, media_type="text/html; charset=utf-8", headers=headers)
+
+def _sse_event(event: str, data: dict) -> str:
+    """將一筆資料序列化為 Server-Sent Events 格式。"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
 
 @app.post("/api/generate-direct-code")
 async def api_generate_direct_code(request: Dict[str, str]):
-    """API 端點：接收用戶描述，調用核心功能生成並驗證程式碼。"""
+    """API 端點：以 SSE 串流生成進度，讓前端即時顯示 AI 輸出，最後送出驗證完成的結果。"""
     description = request.get('description', '')
     if not description:
-        return JSONResponse(status_code=400, content={"error": "請提供專案描述"})
-    
+        return ORJSONResponse(status_code=400, content={"error": "請提供專案描述"})
+
     arduino_system.user_description = description
 
-    try:
-        generation_result = await arduino_system.generate_code_and_instructions(description)
-        if not generation_result or "arduino_code" not in generation_result:
-            return JSONResponse(status_code=500, content={"error": "AI程式碼生成失敗，模型未返回有效內容或格式錯誤。"})
-        
-        is_valid, final_result = await arduino_system.validate_and_fix_code(generation_result)
-        
-        if not is_valid:
-            return JSONResponse(status_code=400, content={
-                "error": "生成的程式碼無法通過驗證與修復，請檢查需求或稍後再試。", 
+    async def event_stream():
+        chunks: List[str] = []
+        try:
+            prompt = arduino_system._build_generation_prompt(description)
+            async for delta in arduino_system._call_gemini_api_stream(prompt, is_json_output=True):
+                chunks.append(delta)
+                yield _sse_event("delta", {"text": delta})
+
+            full_text = "".join(chunks)
+            generation_result = arduino_system._extract_code_from_json(full_text) if full_text else None
+            if not generation_result or "arduino_code" not in generation_result:
+                yield _sse_event("error", {"error": "AI程式碼生成失敗，模型未返回有效內容或格式錯誤。"})
+                return
+
+            yield _sse_event("status", {"message": "🔧 正在驗證與修復程式碼..."})
+            is_valid, final_result = await arduino_system.validate_and_fix_code(generation_result)
+
+            if not is_valid:
+                yield _sse_event("error", {
+                    "error": "生成的程式碼無法通過驗證與修復，請檢查需求或稍後再試。",
+                    "arduino_code": final_result.get("arduino_code"),
+                    "wiring_instructions": final_result.get("wiring_instructions")
+                })
+                return
+
+            yield _sse_event("result", {
                 "arduino_code": final_result.get("arduino_code"),
-                "wiring_instructions": final_result.get("wiring_instructions")
+                "wiring_instructions": final_result.get("wiring_instructions"),
+                "message": "AI成功生成程式碼與接線指南",
             })
-        
-        return JSONResponse(content={
-            "arduino_code": final_result.get("arduino_code"), 
-            "wiring_instructions": final_result.get("wiring_instructions"),
-            "message": "AI成功生成程式碼與接線指南",
-        })
-    except ValueError as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
-    except Exception as e:
-        print(f"伺服器內部錯誤: {e}")
-        return JSONResponse(status_code=500, content={"error": "伺服器處理時發生未預期的錯誤。"})
+        except ValueError as e:
+            yield _sse_event("error", {"error": str(e)})
+        except Exception as e:
+            print(f"伺服器內部錯誤: {e}")
+            yield _sse_event("error", {"error": "伺服器處理時發生未預期的錯誤。"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.post("/api/deploy")
 async def api_deploy_code(request: Dict[str, str]):
     """【新】API 端點：從前端請求中獲取程式碼並進行部署。"""
     code_to_deploy = request.get("code")
     if not code_to_deploy:
-        return JSONResponse(status_code=400, content={"error": "請求中未包含程式碼"})
+        return ORJSONResponse(status_code=400, content={"error": "請求中未包含程式碼"})
     
     port = request.get("port", "auto")
     result = await arduino_system.deploy_to_arduino(code_to_deploy, port=port)
-    return JSONResponse(content=result)
+    return ORJSONResponse(content=result)
 
 @app.get("/api/debug/devices")
-async def debug_devices():
-    """API 端點：調試用，列出所有檢測到的設備和 CLI 狀態。"""
-    arduino_system.arduino_cli_path = arduino_system.find_arduino_cli()
-    cli_version = "N/A"
-    cli_success = False
-    if arduino_system.arduino_cli_path:
-        try:
-            res = subprocess.run([arduino_system.arduino_cli_path, "version"], capture_output=True, text=True, check=True)
-            cli_version = res.stdout.strip()
-            cli_success = True
-        except Exception:
-             cli_version = "無法執行"
-    
+async def debug_devices(refresh: int = 0):
+    """API 端點：調試用，列出所有檢測到的設備和 CLI 狀態。
+
+    CLI 路徑與版本在啟動時已探測並快取，此處只做字典查詢；
+    帶上 `?refresh=1` 可強制重新探測（例如剛安裝好 CLI 時）。
+    """
+    if refresh or arduino_system._cli_version_cache is None:
+        arduino_system.arduino_cli_path = arduino_system.find_arduino_cli()
+    cli_success, cli_version = arduino_system._cli_version_cache
+
     devices = arduino_system.detect_arduino_devices()
-    return JSONResponse(content={"devices": devices, "arduino_cli": {"success": cli_success, "version": cli_version}, "arduino_count": len([d for d in devices if d['is_arduino']])})
+    return ORJSONResponse(content={"devices": devices, "arduino_cli": {"success": cli_success, "version": cli_version}, "arduino_count": len([d for d in devices if d['is_arduino']])})
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """伺服器關閉時釋放共用的 HTTP 連線池。"""
+    await arduino_system.aclose()
 
 # --------------------------------------------------------------------------
 # Main Execution Block